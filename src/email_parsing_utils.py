@@ -1,17 +1,39 @@
+import binascii
+import collections
 import csv
 import email
+import io
+import itertools
 import logging
-import mailbox
-import mimetypes
+import multiprocessing
 import os
+import quopri
 import re
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timezone
+from email.header import Header, decode_header, make_header
 from email.utils import parsedate_to_datetime
 from email.policy import default
 
 logger = logging.getLogger(__name__)
-SUPPORTED_EXTENSIONS = ["eml", "mbox"]
+# Write buffer size for CSV output, large archives produce many rows.
+CSV_WRITE_BUFFER_SIZE = 1 << 20
+# Number of processes used to parse MBOX messages in parallel.
+MBOX_PARSER_WORKERS = int(os.getenv("OPENRELIK_EMAIL_PARSER_WORKERS", 1))
+# Messages queued per parser process, bounds memory use on large archives.
+MBOX_MESSAGES_PER_WORKER = 16
+# Size of the encoded chunks attachment payloads are decoded in.
+PAYLOAD_DECODE_CHUNK_SIZE = 64 * 1024
+# Line breaks of folded header values.
+_HEADER_FOLDING_RE = re.compile(r"\r?\n(?=[ \t])")
+# Characters that require a CSV field to be quoted.
+_CSV_QUOTE_RE = re.compile(rb'[",\r\n]')
+# Maps characters that are invalid in filenames to underscores.
+_INVALID_FILENAME_CHARS = str.maketrans(dict.fromkeys('<>:"/\\|?*', '_'))
+# Numbers messages without a Message-ID header.
+_message_counter = itertools.count()
 
 from openrelik_worker_common.file_utils import create_output_file
 
@@ -28,7 +50,113 @@ def santitize_filename(filename):
         str: A sanitized version of the filename.
     """
     # Replace invalid characters with underscores
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+    return filename.translate(_INVALID_FILENAME_CHARS)
+
+
+def write_chunks_to_file(file_path, chunks):
+    """
+    Writes chunks of bytes to a file using unbuffered OS level I/O.
+
+    Args:
+        file_path (str): Path of the file to create or truncate.
+        chunks (iterable): Iterable of bytes to write in order.
+    """
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for chunk in chunks:
+            view = memoryview(chunk)
+            # os.write() may write fewer bytes than requested
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def write_bytes_to_file(file_path, data):
+    """
+    Writes bytes to a file using unbuffered OS level I/O.
+
+    Args:
+        file_path (str): Path of the file to create or truncate.
+        data (bytes): The data to write.
+    """
+    write_chunks_to_file(file_path, (data,))
+
+
+def iter_decoded_payload(part):
+    """
+    Lazily decodes the payload of a message part.
+
+    Base64 and quoted-printable payloads are decoded in chunks of about
+    PAYLOAD_DECODE_CHUNK_SIZE encoded characters, so the decoded payload
+    is never held in memory as a whole. Other payloads are decoded at
+    once.
+
+    Args:
+        part (object): A non-multipart message part.
+
+    Yields:
+        bytes: The next chunk of the decoded payload.
+
+    Raises:
+        binascii.Error: If a base64 payload is malformed.
+        ValueError: If a base64 payload is padded before its end.
+        ValueError: If the payload contains non-ASCII characters.
+    """
+    encoding = str(part.get("Content-Transfer-Encoding", "")).strip().lower()
+    if encoding not in ("base64", "quoted-printable"):
+        yield part.get_payload(decode=True)
+        return
+
+    payload = part.get_payload()
+    chunk_size = PAYLOAD_DECODE_CHUNK_SIZE
+
+    if encoding == "base64":
+        leftover = ""
+        for start in range(0, len(payload), chunk_size):
+            data = leftover + "".join(payload[start:start + chunk_size].split())
+            # binascii stops decoding at the first pad, so padding is only
+            # decoded in chunks when it ends the payload. Anything else
+            # would make the output depend on chunk boundaries.
+            if "=" in data and (
+                start + chunk_size < len(payload)
+                or "=" in data.rstrip("=")
+            ):
+                raise ValueError("Base64 padding before the end of payload")
+            # Only whole 4 character groups can be decoded on their own
+            usable = len(data) - len(data) % 4
+            leftover = data[usable:]
+            if usable:
+                yield binascii.a2b_base64(data[:usable])
+        if leftover:
+            yield binascii.a2b_base64(leftover + "=" * (-len(leftover) % 4))
+        return
+
+    # Split quoted-printable payloads on line ends so soft line breaks
+    # are never cut in half.
+    start = 0
+    while start < len(payload):
+        end = payload.find("\n", start + chunk_size)
+        end = len(payload) if end == -1 else end + 1
+        yield quopri.decodestring(payload[start:end].encode("ascii"))
+        start = end
+
+
+def write_part_payload_to_file(part, file_path):
+    """
+    Decodes the payload of a message part into a file.
+
+    Falls back to the email package's own, more lenient, decoding if
+    the payload can't be decoded in chunks.
+
+    Args:
+        part (object): A non-multipart message part.
+        file_path (str): Path of the file to create or truncate.
+    """
+    try:
+        write_chunks_to_file(file_path, iter_decoded_payload(part))
+    except ValueError:
+        write_bytes_to_file(file_path, part.get_payload(decode=True))
 
 
 def convert_timestamp_to_utc(date_str):
@@ -53,6 +181,69 @@ def convert_timestamp_to_utc(date_str):
         return None
 
 
+def decode_header_value(value):
+    """
+    Decodes a header value the way the default policy does.
+
+    Messages parsed with the compat32 policy return header values as
+    they appear on the wire. This unfolds them, decodes raw 8-bit bytes
+    as UTF-8 and decodes RFC 2047 encoded words.
+
+    Args:
+        value (str): The header value, may be None.
+
+    Returns:
+        str: The decoded header value, or None if value is None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, Header):
+        # compat32 wraps values holding raw 8-bit bytes in a Header with
+        # the unknown-8bit charset, RFC 6532 makes UTF-8 the sane guess.
+        value = "".join(
+            chunk.decode("utf-8", errors="replace")
+            if isinstance(chunk, bytes) else chunk
+            for chunk, _ in decode_header(value)
+        )
+    elif not value.isascii():
+        # Parameter values such as filenames keep raw bytes as surrogates
+        value = value.encode("utf-8", errors="surrogateescape").decode(
+            "utf-8", errors="replace")
+    if "\n" in value:
+        value = _HEADER_FOLDING_RE.sub("", value)
+    if "=?" not in value:
+        return value
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def get_part_filename(part):
+    """
+    Returns the decoded filename of a message part.
+
+    compat32 stringifies Header objects before parsing parameters, which
+    mangles raw 8-bit filenames. Such headers are decoded first.
+
+    Args:
+        part (object): The message part.
+
+    Returns:
+        str: The filename of the part, or None if it has none.
+    """
+    headers = [
+        (name, part.get(name))
+        for name in ("Content-Disposition", "Content-Type")
+    ]
+    if any(isinstance(value, Header) for _, value in headers):
+        part = email.message.Message()
+        for name, value in headers:
+            if value is not None:
+                part[name] = decode_header_value(value)
+    return decode_header_value(part.get_filename())
+
+
 def extract_message_metadata(attachments, message):
     """
     Extracts metadata from an email message.
@@ -70,20 +261,42 @@ def extract_message_metadata(attachments, message):
         "Timestamp": convert_timestamp_to_utc(message.get("Date")),
         "Timestamp_desc": "Email received",
         "Message": "Email message",
-        "To": message.get("To"),
-        "From": message.get("From"),
-        "Bcc": message.get("Bcc"),
-        "Cc": message.get("Cc"),
-        "Subject": message.get("Subject"),
-        "Message-ID": message.get("Message-ID", ""),
+        "To": decode_header_value(message.get("To")),
+        "From": decode_header_value(message.get("From")),
+        "Bcc": decode_header_value(message.get("Bcc")),
+        "Cc": decode_header_value(message.get("Cc")),
+        "Subject": decode_header_value(message.get("Subject")),
+        "Message-ID": decode_header_value(message.get("Message-ID", "")),
         "Date": message.get("Date"),
         "Content-Type": message.get_content_type(),
         "Attachments": attachments,
-        "User-Agent": message.get("User-Agent"),
+        "User-Agent": decode_header_value(message.get("User-Agent")),
         "Body": get_message_body(message),
     }
 
 
+def iter_leaf_parts(message):
+    """
+    Yields the non-multipart parts of a message in depth-first order.
+
+    Unlike message.walk(), multipart containers are descended into
+    without being yielded.
+
+    Args:
+        message (object): The email message object.
+
+    Yields:
+        object: The next leaf part of the message.
+    """
+    stack = [message]
+    while stack:
+        part = stack.pop()
+        if part.is_multipart():
+            stack.extend(reversed(part.get_payload()))
+            continue
+        yield part
+
+
 def get_message_body(message):
     """
     Extracts the body of an email message.
@@ -95,13 +308,13 @@ def get_message_body(message):
         str: The plain text body of the email.
     """
     if message.is_multipart():
-        for part in message.walk():
+        for part in iter_leaf_parts(message):
             if part.get_content_type() == "text/plain":
                 return part.get_payload(decode=True).decode(
                     part.get_content_charset() or "utf-8",
                     errors="replace"
                 )
-    else:
+    elif message.get_content_maintype() == "text":
         return message.get_payload(decode=True).decode(
             message.get_content_charset() or "utf-8",
             errors="replace"
@@ -109,23 +322,76 @@ def get_message_body(message):
     return ""
 
 
-def write_dict_to_csv(message_dict, headers, output_file):
+def write_dict_to_csv(rows, headers, output_file):
+    """
+    Writes out message rows to a CSV file.
+
+    Args:
+        rows (iterable): Iterable of row tuples ordered like headers.
+        headers (list): List of headers for the CSV file.
+        output_file (str): Path to the output CSV file.
+
+    Returns:
+        str: Path to the output CSV file.
+    """
+    raw_file = open(output_file.path, mode="wb", buffering=CSV_WRITE_BUFFER_SIZE)
+    with io.TextIOWrapper(
+        raw_file, encoding="utf-8", newline="", write_through=False
+    ) as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+    return output_file
+
+
+def fast_csv_row(values):
+    """
+    Formats a row as a UTF-8 encoded CSV line.
+
+    Fields are quoted the same way as csv.writer's default dialect does,
+    None becomes an empty field and other values are converted with
+    str().
+
+    Args:
+        values (tuple): The field values of the row.
+
+    Returns:
+        bytes: The CSV line, terminated with CRLF.
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append(b"")
+            continue
+        field = (value if isinstance(value, str) else str(value)).encode("utf-8")
+        if _CSV_QUOTE_RE.search(field):
+            field = b'"' + field.replace(b'"', b'""') + b'"'
+        fields.append(field)
+    return b",".join(fields) + b"\r\n"
+
+
+def write_fast_csv(rows, headers, output_file):
     """
-    Writes out a dictionary to a CSV file.
+    Writes out message rows to a CSV file without the csv module.
+
+    Rows are formatted with fast_csv_row() and written as bytes, which
+    skips the text layer for archives with many rows.
 
     Args:
+        rows (iterable): Iterable of row tuples ordered like headers.
         headers (list): List of headers for the CSV file.
-        message_dict (dict): Dict of parsed message data
         output_file (str): Path to the output CSV file.
 
     Returns:
         str: Path to the output CSV file.
     """
     with open(
-        output_file.path, mode="w", newline="", encoding="utf-8") as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=headers)
-        writer.writeheader()
-        writer.writerows(message_dict)
+        output_file.path, mode="wb", buffering=CSV_WRITE_BUFFER_SIZE
+    ) as csv_file:
+        csv_file.write(fast_csv_row(headers))
+        for row in rows:
+            csv_file.write(fast_csv_row(row))
 
     return output_file
 
@@ -142,18 +408,13 @@ def parse_eml_to_dict_and_extract_attachments(file_path, output_path):
     """
     attachment_file_paths = []
 
-    with open(file_path, "r", encoding="utf-8") as eml_file:
-        msg = email.message_from_file(eml_file, policy=default)
-        message_attachments = extract_message_attachments(
+    with open(file_path, "rb") as eml_file:
+        msg = email.message_from_binary_file(eml_file, policy=default)
+        message_attachments, attachments = extract_message_attachments(
             message=msg,
             output_path=output_path
         )
         attachment_file_paths.extend(message_attachments)
-        attachments = [
-            part.get_filename()
-            for part in msg.walk()
-            if part.get_filename()
-        ]
 
         email_metadata = extract_message_metadata(
             attachments=attachments,
@@ -170,109 +431,185 @@ def extract_message_attachments(message, output_path):
         message (object): The email message object.
         output_path (str): The path to the output directory where
             attachments will be saved.
+
+    Returns:
+        list: A list of output file dicts for the extracted files.
+        list: The filenames of all message parts that have one.
     """
     extracted_files = []
+    attachment_names = []
 
-    if (
-        isinstance(message, email.message.EmailMessage)
-        or isinstance(message, mailbox.mboxMessage)
-    ):
-        message_id = santitize_filename(filename=message.get("Message-ID", ""))
+    if isinstance(message, email.message.Message):
+        message_id = santitize_filename(
+            filename=decode_header_value(message.get("Message-ID", "")))
         if not message_id:
-            message_id = "unknown_message_" + str(abs(hash(str(message))))[:8]
-
-        for part in message.walk():
-            # Skip the main message container and alternative text/html
-            # parts that don't have a filename
-            if part.is_multipart():
+            # The process ID keeps the name unique across parser processes
+            message_id = (
+                f"unknown_message_{os.getpid():x}_{next(_message_counter):08x}")
+        # Add the message ID to the display names for uniqueness
+        message_id_suffix = f".{message_id}"
+
+        for part in iter_leaf_parts(message):
+            # Skip alternative text/html parts that don't have a filename
+            filename = get_part_filename(part)
+            if not filename:
                 continue
+            attachment_names.append(filename)
+
+            # Get the content disposition type and content type. Unlike
+            # the raw header, get_content_disposition() also handles the
+            # Header objects compat32 returns for raw 8-bit values.
+            disposition = part.get_content_disposition()
+            maintype = part.get_content_maintype()
+
+            # Grab inline and attached files
+            if disposition in ("attachment", "inline") or \
+               (not disposition and maintype != 'text'):
+
+                base, ext = os.path.splitext(filename)
+                processed_base = base # 'filename_base'
+                processed_ext = ext[1:] # 'png'
+                attachment_file_display_name = processed_base + message_id_suffix
+
+                try:
+                    output_file = create_output_file(
+                        output_path,
+                        display_name=attachment_file_display_name,
+                        extension=processed_ext,
+                        data_type=processed_ext,
+                    )
+                    write_part_payload_to_file(part, output_file.path)
+                    logger.info(f"Saved file: {output_file.path} (Disposition: {disposition or 'implicit'})")
 
-            filename = part.get_filename()
-            if filename:
-                # Get the content disposition header and content type
-                disposition = part.get("Content-Disposition")
-                maintype = part.get_content_maintype()
-
-                # Grab inline and attached files
-                if (disposition and disposition.strip().lower().startswith(("attachment", "inline"))) or \
-                   (not disposition and maintype != 'text' and filename):
-
-                    base, ext = os.path.splitext(filename)
-                    processed_base = base # 'filename_base'
-                    processed_ext = ext[1:] # 'png'
-                    # Add the message ID to the display name for uniqueness
-                    attachment_file_display_name = f"{processed_base}.{message_id}"
-
-                    try:
-                        output_file = create_output_file(
-                            output_path,
-                            display_name=attachment_file_display_name,
-                            extension=processed_ext,
-                            data_type=processed_ext,
-                        )
-                        with open(output_file.path, 'wb') as out_f:
-                            out_f.write(part.get_payload(decode=True))
-                        logger.info(f"Saved file: {output_file.path} (Disposition: {disposition or 'implicit'})")
-
-                        extracted_files.append(output_file.to_dict())
-
-                    except Exception as e:
-                        logger.error(f"Failed to save file {filename}: {e}")
-                else:
-                    logger.debug(f"Skipping part with filename '{filename}' (Disposition: {disposition}, Maintype: {maintype}).")
+                    extracted_files.append(output_file.to_dict())
+
+                except Exception as e:
+                    logger.error(f"Failed to save file {filename}: {e}")
             else:
-                pass 
+                logger.debug(f"Skipping part with filename '{filename}' (Disposition: {disposition}, Maintype: {maintype}).")
     else:
         logger.warning("Unsupported message type for attachment extraction.")
 
-    return extracted_files
+    return extracted_files, attachment_names
 
 
-def parse_mbox_to_dict_and_extract_attachments(file_path, output_path):
+def iter_mbox_message_bytes(file_path):
     """
-    Parses an MBOX file and generate a metadata dict for each message. 
-    Extract attachments and save them to the specified output path.
+    Lazily yields the raw bytes of each message in an MBOX file.
+
+    The archive is read line by line and split on the "From " separator
+    lines, so only a single message is held in memory at any time.
 
     Args:
         file_path (str): Path to the MBOX file.
+
+    Yields:
+        bytes: The raw bytes of the next message in the archive.
+
+    Raises:
+        ValueError: If the file does not start with a "From " line.
+    """
+    with open(file_path, "rb") as mbox_file:
+        first_line = mbox_file.readline()
+        if not first_line:
+            return
+        if not first_line.startswith(b"From "):
+            raise ValueError(
+                f"'{file_path}' is not a valid Mbox file format.")
+
+        buffer = []
+        for line in mbox_file:
+            if line.startswith(b"From "):
+                # The blank line preceding a separator belongs to the
+                # mbox framing, not to the message.
+                if buffer and buffer[-1] in (b"\n", b"\r\n"):
+                    buffer.pop()
+                yield b"".join(buffer)
+                buffer = []
+            else:
+                buffer.append(line)
+
+        yield b"".join(buffer)
+
+
+def parse_message_bytes(message_bytes, output_path):
+    """
+    Parses a raw message and extracts its attachments.
+
+    Args:
+        message_bytes (bytes): The raw bytes of the message.
         output_path (str): Path to the output directory for artifacts.
 
     Returns:
-        list: A list of dictionaries containing metadata for each email.
-        list: A list of output file dicts for the attachments.
+        list: A list of output file dicts for the message attachments.
+        dict: A dictionary containing metadata for the email.
     """
-    attachment_file_paths = []
-    messages_metadata = []
+    # Only a handful of headers are read, the compat32 policy skips the
+    # richer header parsing of the default policy.
+    message = email.message_from_bytes(message_bytes)
+    attachment_file_paths, attachment_filenames = extract_message_attachments(
+        message=message,
+        output_path=output_path
+    )
 
-    try:
-        mbox = mailbox.mbox(file_path)
-        logger.info(f"Opened MBOX file: {file_path}")
+    return attachment_file_paths, extract_message_metadata(
+        message=message,
+        attachments=attachment_filenames
+    )
 
-        for message in mbox:
-            attachment_filenames = []
-            attachment_file_paths = []
-
-            # Handle attachments and inline content while iterating
-            # through messages.
-            for part in message.walk():
-                filename = part.get_filename()
-                if filename:
-                    message_content = extract_message_attachments(
-                        message=message,
-                        output_path=output_path
-                    )
-                    attachment_file_paths.extend(message_content)
 
-            messages_metadata.append(
-                extract_message_metadata(message=message,
-                                         attachments=attachment_filenames)
-            )
+def iter_mbox_metadata(file_path, output_path, max_workers=MBOX_PARSER_WORKERS):
+    """
+    Parses an MBOX file and lazily generates a metadata dict for each
+    message. Extract attachments and save them to the specified output
+    path.
+
+    Messages are parsed in a pool of max_workers processes. Results are
+    yielded in archive order. Daemonic processes, such as Celery prefork
+    pool workers, can't start a pool and always parse in-process.
+
+    Args:
+        file_path (str): Path to the MBOX file.
+        output_path (str): Path to the output directory for artifacts.
+        max_workers (int): Number of parser processes, 1 parses the
+          messages in the current process.
 
-    except mailbox.NoSuchMailboxError:
-        logger.error(f"Error: '{file_path}' is not a valid Mbox file format.")
+    Yields:
+        tuple: A list of output file dicts for the message attachments
+          and a dictionary containing metadata for the email.
+    """
+    try:
+        logger.info(f"Opened MBOX file: {file_path}")
+        messages = iter_mbox_message_bytes(file_path)
+
+        if max_workers <= 1 or multiprocessing.current_process().daemon:
+            for message_bytes in messages:
+                yield parse_message_bytes(message_bytes, output_path)
+            return
+
+        # Executor.map() would read the whole archive up front, so keep a
+        # bounded queue of pending messages instead.
+        max_pending = max_workers * MBOX_MESSAGES_PER_WORKER
+        # Forking a multi-threaded worker, e.g. Celery's threads pool, may
+        # deadlock the children. Start them from a fork server instead.
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        ) as executor:
+            pending = collections.deque()
+            for message_bytes in messages:
+                pending.append(executor.submit(
+                    parse_message_bytes, message_bytes, output_path))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    except ValueError as e:
+        logger.error(f"Error: {e}")
+    except (AssertionError, BrokenProcessPool):
+        # A failing parser pool must not end up as an empty CSV file
+        raise
     except Exception as e:
         logger.warning(
             f"An unexpected error occurred while processing the Mbox file: {e}")
-
-    return attachment_file_paths, messages_metadata
-
@@ -1,11 +1,18 @@
 """OpenRelik Worker Email Parser Task"""
 
 import logging
-import src.email_parsing_utils as email_parsing_utils
+from operator import itemgetter
 
 from openrelik_worker_common.file_utils import create_output_file
 from openrelik_worker_common.task_utils import create_task_result, get_input_files
 
+from src.email_parsing_utils import (
+    iter_mbox_metadata,
+    parse_eml_to_dict_and_extract_attachments,
+    write_dict_to_csv,
+    write_fast_csv,
+)
+
 from .app import celery
 
 logger = logging.getLogger(__name__)
@@ -30,6 +37,74 @@ TASK_METADATA = {
     ],
 }
 
+# Columns of the CSV output and the getter building a row from a metadata
+# dict in column order.
+CSV_HEADERS = (
+    "Timestamp", "Timestamp_desc", "Message", "To", "From", "Bcc",
+    "Cc", "Subject", "Message-ID", "Date", "Content-Type",
+    "Attachments", "User-Agent", "Body")
+_ROW_GETTER = itemgetter(*CSV_HEADERS)
+
+
+def process_mbox_file(file_path, output_path, output_file):
+    """Parse an MBOX file into a CSV file and extract its attachments.
+
+    Args:
+        file_path: Path to the MBOX file.
+        output_path: Path to the output directory.
+        output_file: The OutputFile to write the CSV rows to.
+
+    Returns:
+        The CSV OutputFile and a list of attachment output file dicts.
+    """
+    attachment_file_paths = []
+    mbox_messages = iter_mbox_metadata(
+        file_path=file_path,
+        output_path=output_path)
+
+    # Rows are streamed straight into the CSV writer so only one
+    # message is held in memory at a time.
+    def mbox_rows():
+        for message_attachments, message_metadata in mbox_messages:
+            attachment_file_paths.extend(message_attachments)
+            yield _ROW_GETTER(message_metadata)
+
+    mbox_csv = write_fast_csv(
+        rows=mbox_rows(), headers=CSV_HEADERS,
+        output_file=output_file)
+
+    return mbox_csv, attachment_file_paths
+
+
+def process_eml_file(file_path, output_path, output_file):
+    """Parse an EML file into a CSV file and extract its attachments.
+
+    Args:
+        file_path: Path to the EML file.
+        output_path: Path to the output directory.
+        output_file: The OutputFile to write the CSV row to.
+
+    Returns:
+        The CSV OutputFile and a list of attachment output file dicts.
+    """
+    attachment_file_paths, eml_dict = parse_eml_to_dict_and_extract_attachments(
+        file_path=file_path,
+        output_path=output_path)
+    eml_csv = write_dict_to_csv(
+        rows=[_ROW_GETTER(eml_dict)],
+        headers=CSV_HEADERS,
+        output_file=output_file)
+
+    return eml_csv, attachment_file_paths
+
+
+# Input file handlers by lowercase extension.
+_HANDLERS = {
+    "eml": process_eml_file,
+    "mbox": process_mbox_file,
+}
+SUPPORTED_EXTENSIONS = frozenset(_HANDLERS)
+
 
 @celery.task(bind=True, name=TASK_NAME, metadata=TASK_METADATA)
 def command(
@@ -56,17 +131,14 @@ def command(
     """
     input_files = get_input_files(pipe_result, input_files or [])
     output_files = []
-    csv_headers = [
-        "Timestamp", "Timestamp_desc", "Message", "To", "From", "Bcc",
-        "Cc", "Subject", "Message-ID", "Date", "Content-Type",
-        "Attachments", "User-Agent", "Body"]
 
     for input_file in input_files:
         input_extension = input_file.get("extension", "").lower()
 
-        if input_extension not in email_parsing_utils.SUPPORTED_EXTENSIONS:
-            logging.info('Skipping file with unsupported extension:',
-                   input_file['extension'])
+        handler = _HANDLERS.get(input_extension)
+        if handler is None:
+            logging.info(
+                f"Skipping file with unsupported extension: {input_extension}")
             continue
 
         output_file = create_output_file(
@@ -76,42 +148,21 @@ def command(
             data_type="csv",
         )
 
-        # MBOX
-        if input_extension == "mbox":
-            logging.info(f"Processing MBOX file: {input_file.get('path')}")
-
-            attachment_file_paths, mbox_dict = email_parsing_utils.parse_mbox_to_dict_and_extract_attachments(
-                file_path=input_file.get("path"),
-                output_path=output_path)
-            mbox_csv = email_parsing_utils.write_dict_to_csv(
-                message_dict=mbox_dict, headers=csv_headers,
-                output_file=output_file)
-            output_files.append(mbox_csv.to_dict())
-
-            # Add attachments to output files
-            if attachment_file_paths:
-                output_files.extend(attachment_file_paths)
-
-        # EML
-        if input_extension == "eml":
-            logging.info(f"Processing EML file: {input_file.get('path')}")
-
-            attachment_file_paths, eml_dict = email_parsing_utils.parse_eml_to_dict_and_extract_attachments(
-                file_path=input_file.get("path"),
-                output_path=output_path)
-            eml_csv = email_parsing_utils.write_dict_to_csv(
-                message_dict=[eml_dict],
-                headers=csv_headers,
-                output_file=output_file)
-            output_files.append(eml_csv.to_dict())
-
-            # Add attachments to output files
-            if attachment_file_paths:
-                output_files.extend(attachment_file_paths)
+        logging.info(
+            f"Processing {input_extension.upper()} file: {input_file.get('path')}")
+        csv_file, attachment_file_paths = handler(
+            file_path=input_file.get("path"),
+            output_path=output_path,
+            output_file=output_file)
+        output_files.append(csv_file.to_dict())
+
+        # Add attachments to output files
+        if attachment_file_paths:
+            output_files.extend(attachment_file_paths)
 
     if not output_files:
         raise RuntimeError(
-            f"No compatible input files found. Supported extensions: {', '.join(email_parsing_utils.SUPPORTED_EXTENSIONS)}."
+            f"No compatible input files found. Supported extensions: {', '.join(sorted(SUPPORTED_EXTENSIONS))}."
         )
 
     return create_task_result(
@@ -4,7 +4,9 @@ from unittest.mock import MagicMock
 
 import csv
 import email
+import io
 import mailbox
+import multiprocessing
 import os
 import pytest
 import sys
@@ -12,15 +14,17 @@ import sys
 #sys.modules["openrelik_worker_common"] = MagicMock()
 #sys.modules["openrelik_worker_common.file_utils"] = MagicMock()
 
+from concurrent.futures.process import BrokenProcessPool
 from unittest.mock import MagicMock, patch
 
 from src.email_parsing_utils import (
-    santitize_filename, convert_timestamp_to_utc,
+    santitize_filename, convert_timestamp_to_utc, decode_header_value,
     create_output_file, get_message_body,
     extract_message_metadata, extract_message_attachments,
-    parse_eml_to_dict_and_extract_attachments,
-    parse_mbox_to_dict_and_extract_attachments,
-    write_dict_to_csv)
+    iter_decoded_payload, iter_leaf_parts, iter_mbox_message_bytes, iter_mbox_metadata,
+    parse_eml_to_dict_and_extract_attachments, parse_message_bytes,
+    fast_csv_row, write_bytes_to_file, write_dict_to_csv, write_fast_csv,
+    write_part_payload_to_file)
 
 
 # Message test metadata
@@ -82,6 +86,14 @@ MSG_TEST_DATA_FILENAMES = list(MSG_TEST_METADATA.keys())
 
 
 # Testing utility functions
+def parse_mbox_in_process(file_path, output_path, result_queue):
+    """Parse an MBOX file with a parser pool and report the result counts."""
+    results = list(iter_mbox_metadata(
+        file_path=file_path, output_path=output_path, max_workers=2))
+    result_queue.put(
+        (len(results), sum(len(attachments) for attachments, _ in results)))
+
+
 def make_plain_email(body, charset="utf-8"):
     """Create a plain text EmailMessage."""
     msg = EmailMessage()
@@ -134,6 +146,74 @@ def test_santitize_filename(input_str, expected):
     """Test that santitize_filename returns the expected sanitized filename."""
     assert santitize_filename(input_str) == expected
 
+def test_write_bytes_to_file(tmp_path):
+    """Test that write_bytes_to_file creates and truncates the file."""
+    file_path = tmp_path / "attachment.bin"
+    file_path.write_bytes(b"previous longer content")
+
+    write_bytes_to_file(str(file_path), b"\x00data")
+
+    assert file_path.read_bytes() == b"\x00data"
+
+
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable", "7bit"])
+def test_iter_decoded_payload(monkeypatch, cte):
+    """Test that chunked payload decoding matches get_payload(decode=True)."""
+    # Arrange
+    monkeypatch.setattr(
+        "src.email_parsing_utils.PAYLOAD_DECODE_CHUNK_SIZE", 10)
+    msg = EmailMessage()
+    if cte == "7bit":
+        msg.set_content("Plain line\n" * 20, cte=cte)
+    else:
+        msg.set_content(bytes(range(256)) * 4, maintype="application",
+                        subtype="octet-stream", cte=cte)
+    part = email.message_from_bytes(msg.as_bytes())
+
+    # Act
+    decoded = b"".join(iter_decoded_payload(part))
+
+    # Assert
+    assert decoded == part.get_payload(decode=True)
+
+
+@pytest.mark.parametrize("chunk_size", [6, 8, 10])
+def test_write_part_payload_to_file_base64_pad_before_end(
+        tmp_path, monkeypatch, chunk_size):
+    """Test that a pad before the end decodes the same on any chunk boundary."""
+    # Arrange
+    monkeypatch.setattr(
+        "src.email_parsing_utils.PAYLOAD_DECODE_CHUNK_SIZE", chunk_size)
+    part = email.message_from_bytes(
+        b"Content-Type: application/octet-stream\n"
+        b"Content-Transfer-Encoding: base64\n"
+        b"\n"
+        b"QUJDQQ==QUJD\n"
+    )
+    file_path = tmp_path / "attachment.bin"
+
+    # Act
+    write_part_payload_to_file(part, str(file_path))
+
+    # Assert
+    assert file_path.read_bytes() == part.get_payload(decode=True)
+
+
+def test_write_part_payload_to_file_malformed_base64(tmp_path):
+    """Test that malformed base64 falls back to the email package decoder."""
+    part = email.message_from_bytes(
+        b"Content-Type: application/octet-stream\n"
+        b"Content-Transfer-Encoding: base64\n"
+        b"\n"
+        b"VGhpcyBpcyBkYXRhQ\n"
+    )
+    file_path = tmp_path / "attachment.bin"
+
+    write_part_payload_to_file(part, str(file_path))
+
+    assert file_path.read_bytes() == part.get_payload(decode=True)
+
+
 @pytest.mark.parametrize(
     "input_str,expected_prefix",
     [
@@ -160,6 +240,34 @@ def test_convert_timestamp_to_utc(input_str, expected_prefix):
         assert result is not None, f"Expected a string starting with {expected_prefix}, got None"
         assert result.startswith(expected_prefix)
 
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, None),
+        ("", ""),
+        ("Plain subject", "Plain subject"),
+        ("=?utf-8?b?0J/RgNC40LLQtdGC?=", "Привет"),
+        ("=?iso-8859-1?q?caf=E9?= menu", "café menu"),
+    ]
+)
+def test_decode_header_value(value, expected):
+    """Test that decode_header_value decodes RFC 2047 encoded words."""
+    assert decode_header_value(value) == expected
+
+
+def test_iter_leaf_parts():
+    """Test that iter_leaf_parts yields the same leaves as walk(), in order."""
+    msg = make_multipart_email("Plain part", "<b>HTML part</b>")
+    msg.add_attachment(b"data", maintype="application", subtype="octet-stream",
+                       filename="file.bin")
+
+    leaves = list(iter_leaf_parts(msg))
+
+    assert leaves == [p for p in msg.walk() if not p.is_multipart()]
+    assert [p.get_content_type() for p in leaves] == [
+        "text/plain", "text/html", "application/octet-stream"]
+
+
 @pytest.mark.parametrize(
     "msg,expected",
     [
@@ -181,13 +289,20 @@ def test_get_message_body_no_text_plain():
     assert get_message_body(msg) == ""
 
 
+def test_get_message_body_non_text_single_part():
+    """Test that get_message_body does not decode non-text single part payloads."""
+    msg = EmailMessage()
+    msg.set_content(b"\x00\x01binary", maintype="application", subtype="octet-stream")
+    assert get_message_body(msg) == ""
+
+
 def test_write_dict_to_csv(tmp_path):
-    """Test writing a list of dictionaries to a CSV file."""
+    """Test writing a list of row tuples to a CSV file."""
     # Arrange
     headers = ["col1", "col2", "col3"]
     data = [
-        {"col1": "a", "col2": "b", "col3": "c"},
-        {"col1": "1", "col2": "2", "col3": "3"},
+        ("a", "b", "c"),
+        ("1", "2", "3"),
     ]
 
     # Act
@@ -207,6 +322,244 @@ def test_write_dict_to_csv(tmp_path):
         ]
 
 
+def test_iter_mbox_message_bytes(tmp_path):
+    """Test that iter_mbox_message_bytes yields each message of an MBOX file."""
+    # Arrange
+    mbox_path = tmp_path / "multi.mbox"
+    mbox_path.write_bytes(
+        b"From sender1@example.com Thu Jan  1 00:00:01 2024\n"
+        b"Subject: First\n"
+        b"\n"
+        b"First body\n"
+        b"\n"
+        b"From sender2@example.com Thu Jan  1 00:00:02 2024\n"
+        b"Subject: Second\n"
+        b"\n"
+        b"Second body\n"
+    )
+
+    # Act
+    messages = list(iter_mbox_message_bytes(str(mbox_path)))
+
+    # Assert
+    assert messages == [
+        b"Subject: First\n\nFirst body\n",
+        b"Subject: Second\n\nSecond body\n",
+    ]
+
+
+def test_iter_mbox_message_bytes_invalid_file(tmp_path):
+    """Test that iter_mbox_message_bytes rejects files without a From line."""
+    mbox_path = tmp_path / "invalid.mbox"
+    mbox_path.write_bytes(b"Subject: Not an mbox\n\nBody\n")
+
+    with pytest.raises(ValueError):
+        list(iter_mbox_message_bytes(str(mbox_path)))
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_iter_mbox_metadata_extracts_each_attachment_once(tmp_path, max_workers):
+    """Test that every attachment of every MBOX message is saved once."""
+    # Arrange
+    mbox_path = tmp_path / "attachments.mbox"
+    with open(mbox_path, "wb") as mbox_file:
+        for msg_num in range(2):
+            msg = make_plain_email(f"Body {msg_num}")
+            msg["Message-ID"] = f"<msg{msg_num}@example.com>"
+            for attachment_num in range(3):
+                msg.add_attachment(
+                    b"data", maintype="application", subtype="octet-stream",
+                    filename=f"file{attachment_num}.bin")
+            mbox_file.write(b"From sender@example.com Thu Jan  1 00:00:00 2024\n")
+            mbox_file.write(msg.as_bytes() + b"\n")
+
+    # Act
+    results = list(iter_mbox_metadata(
+        file_path=str(mbox_path), output_path=str(tmp_path),
+        max_workers=max_workers))
+
+    # Assert
+    assert [m["Message-ID"] for _, m in results] == [
+        "<msg0@example.com>", "<msg1@example.com>"]
+    attachments = [a for message_attachments, _ in results for a in message_attachments]
+    assert len(results) == 2
+    assert len(attachments) == 6
+    assert len({a["display_name"] for a in attachments}) == 6
+    for _, message_metadata in results:
+        assert message_metadata["Attachments"] == [
+            "file0.bin", "file1.bin", "file2.bin"]
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ("a", "b", "c"),
+        ("with,comma", 'with "quotes"', "with\nnewline"),
+        ("carriage\rreturn", "", None),
+        (["file1.txt", "file2.txt"], [], "Привет мир"),
+    ]
+)
+def test_fast_csv_row(values):
+    """Test that fast_csv_row matches the csv module's output."""
+    expected = io.StringIO(newline="")
+    csv.writer(expected).writerow(values)
+    assert fast_csv_row(values) == expected.getvalue().encode("utf-8")
+
+
+def test_write_fast_csv(tmp_path):
+    """Test writing row tuples to a CSV file without the csv module."""
+    # Arrange
+    headers = ["col1", "col2", "col3"]
+    data = [
+        ("a", "b,c", None),
+        ("1", "2", "3\n4"),
+    ]
+
+    # Act
+    output_file = MagicMock()
+    output_file.path = str(tmp_path / "test.csv")
+    result = write_fast_csv(data, headers, output_file)
+
+    # Assert
+    assert result == output_file
+
+    with open(output_file.path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        assert rows == [
+            {"col1": "a", "col2": "b,c", "col3": ""},
+            {"col1": "1", "col2": "2", "col3": "3\n4"},
+        ]
+
+
+def test_iter_mbox_metadata_raw_utf8_headers(tmp_path):
+    """Test that raw UTF-8 headers don't stop parsing of the MBOX archive."""
+    # Arrange
+    mbox_path = tmp_path / "raw_utf8.mbox"
+    mbox_path.write_bytes(
+        "From sender@example.com Thu Jan  1 00:00:00 2024\n"
+        "Subject: café résumé\n"
+        "Message-ID: <msg1@example.com>\n"
+        "MIME-Version: 1.0\n"
+        "Content-Type: multipart/mixed; boundary=BOUNDARY\n"
+        "\n"
+        "--BOUNDARY\n"
+        "Content-Type: text/plain\n"
+        "\n"
+        "Body\n"
+        "--BOUNDARY\n"
+        "Content-Type: application/pdf\n"
+        "Content-Disposition: attachment; filename=\"résumé.pdf\"\n"
+        "Content-Transfer-Encoding: base64\n"
+        "\n"
+        "QUJD\n"
+        "--BOUNDARY--\n"
+        "\n"
+        "From sender@example.com Thu Jan  1 00:00:01 2024\n"
+        "Subject: Second message\n"
+        "Message-ID: <msg2@example.com>\n"
+        "\n"
+        "Body\n".encode("utf-8")
+    )
+
+    # Act
+    results = list(iter_mbox_metadata(
+        file_path=str(mbox_path), output_path=str(tmp_path), max_workers=1))
+
+    # Assert
+    attachments = [a for message_attachments, _ in results for a in message_attachments]
+    assert [m["Message-ID"] for _, m in results] == [
+        "<msg1@example.com>", "<msg2@example.com>"]
+    assert len(attachments) == 1
+    with open(attachments[0]["path"], "rb") as f:
+        assert f.read() == b"ABC"
+
+
+@pytest.mark.parametrize(
+    "headers,filename",
+    [
+        # Raw UTF-8 (RFC 6532)
+        ("Subject: café résumé\nFrom: José <jose@example.com>\n", "résumé.pdf"),
+        # Folded headers
+        ("Subject: a very long subject\n that is folded\n"
+         "To: Bob Recipient\n <bob@example.com>\n", "report.pdf"),
+        # RFC 2047 encoded words
+        ("Subject: =?utf-8?q?caf=C3=A9?= menu\n", "menu.pdf"),
+        # Plain ASCII
+        ("Subject: Plain subject\nFrom: alice@example.com\n", "plain.pdf"),
+    ]
+)
+def test_parse_message_bytes_matches_eml_path(tmp_path, headers, filename):
+    """Test that the compat32 MBOX path gives the same metadata as EML."""
+    # Arrange
+    raw_message = (
+        headers +
+        "Message-ID: <msg@example.com>\n"
+        "Date: Mon, 01 Jan 2024 00:00:00 +0000\n"
+        "MIME-Version: 1.0\n"
+        "Content-Type: multipart/mixed; boundary=BOUNDARY\n"
+        "\n"
+        "--BOUNDARY\n"
+        "Content-Type: text/plain\n"
+        "\n"
+        "Body\n"
+        "--BOUNDARY\n"
+        "Content-Type: application/pdf\n"
+        f"Content-Disposition: attachment; filename=\"{filename}\"\n"
+        "Content-Transfer-Encoding: base64\n"
+        "\n"
+        "QUJD\n"
+        "--BOUNDARY--\n"
+    ).encode("utf-8")
+    eml_path = tmp_path / "message.eml"
+    eml_path.write_bytes(raw_message)
+
+    # Act
+    mbox_attachments, mbox_metadata = parse_message_bytes(
+        raw_message, str(tmp_path))
+    eml_attachments, eml_metadata = parse_eml_to_dict_and_extract_attachments(
+        file_path=str(eml_path), output_path=str(tmp_path))
+
+    # Assert
+    assert mbox_metadata == eml_metadata
+    assert mbox_metadata["Attachments"] == [filename]
+    assert [a["display_name"] for a in mbox_attachments] == \
+        [a["display_name"] for a in eml_attachments]
+
+
+def test_iter_mbox_metadata_in_daemonic_process(tmp_path):
+    """Test that daemonic processes, like Celery workers, parse in-process."""
+    # Arrange
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    mbox_path = os.path.join(cwd, 'testdata', 'attachment_message.mbox')
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=parse_mbox_in_process,
+        args=(mbox_path, str(tmp_path), result_queue),
+        daemon=True)
+
+    # Act
+    process.start()
+    result = result_queue.get(timeout=30)
+    process.join()
+
+    # Assert
+    assert result == (1, 1)
+
+
+def test_iter_mbox_metadata_pool_failure_propagates(tmp_path, monkeypatch):
+    """Test that a failing parser pool raises instead of yielding nothing."""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    mbox_path = os.path.join(cwd, 'testdata', 'attachment_message.mbox')
+    monkeypatch.setattr(
+        "src.email_parsing_utils.ProcessPoolExecutor",
+        MagicMock(side_effect=BrokenProcessPool("pool failed")))
+
+    with pytest.raises(BrokenProcessPool):
+        list(iter_mbox_metadata(
+            file_path=mbox_path, output_path=str(tmp_path), max_workers=2))
+
+
 @pytest.mark.parametrize("msg_filename", MSG_TEST_DATA_FILENAMES)
 def test_extract_message_metadata(msg_filename):
     """Test extracting metadata from various types of EML/MBOX messages."""
@@ -233,6 +586,28 @@ def test_extract_message_metadata(msg_filename):
     assert msg_metadata["Attachments"] == attachments
 
 
+@pytest.mark.parametrize("msg_filename", MSG_TEST_DATA_FILENAMES)
+def test_extract_message_attachments(tmp_path, msg_filename):
+    """Test that extract_message_attachments returns files and filenames."""
+    # Arrange
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    msg_path = os.path.join(cwd, 'testdata', msg_filename)
+    msg = return_msg_from_file(file_path=msg_path)
+    expected_attachments = MSG_TEST_METADATA[msg_filename]["Attachments"]
+
+    # Act
+    extracted_files, attachment_names = extract_message_attachments(
+        message=msg,
+        output_path=str(tmp_path)
+    )
+
+    # Assert
+    assert attachment_names == expected_attachments
+    assert len(extracted_files) == len(expected_attachments)
+    for extracted_file in extracted_files:
+        assert os.path.exists(extracted_file["path"])
+
+
 @pytest.mark.parametrize("msg_archive_filename", MSG_TEST_DATA_FILENAMES)
 def test_parse_eml_mbox_to_dict_and_extract_attachments(tmp_path, msg_archive_filename):
     # Arrange
@@ -248,9 +623,12 @@ def test_parse_eml_mbox_to_dict_and_extract_attachments(tmp_path, msg_archive_fi
            file_path=mail_path, 
            output_path=str(output_dir))
     elif msg_archive_filename.endswith('.mbox'):
-       attachments, email_metadata = parse_mbox_to_dict_and_extract_attachments(
+       attachments, email_metadata = [], []
+       for message_attachments, message_metadata in iter_mbox_metadata(
            file_path=mail_path,
-           output_path=str(output_dir))
+           output_path=str(output_dir)):
+           attachments.extend(message_attachments)
+           email_metadata.append(message_metadata)
        
     email_metadata_dict = email_metadata[0] if isinstance(email_metadata, list) else email_metadata
     msg_id = santitize_filename(email_metadata_dict.get("Message-ID", ""))